@@ -1,9 +1,25 @@
 from abc import ABC
+import time
 
 class Base_Logic(ABC):
-    def __init__(self, board):
+    def __init__(self, board, min_period_s=0):
         self.board = board
 
+        # recompute throttling variables
+        self.min_period_s = min_period_s
+        self._last_t = float('-inf')
+        self._cached = {}
+
+    def should_update(self):
+        # true at most once every min_period_s
+        now = time.monotonic()
+        if now - self._last_t < self.min_period_s:
+            return False
+        self._last_t = now
+        return True
+
     def get_data_dict(self):
         ...
-    
\ No newline at end of file
+
+    def update_into(self, full_dict):
+        full_dict.update(self.get_data_dict())
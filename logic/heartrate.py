@@ -1,14 +1,17 @@
 from logic.base_logic import Base_Logic
 
 from brainflow.board_shim import BoardShim, BrainFlowPresets
-from brainflow.data_filter import DataFilter, AggOperations, NoiseTypes, FilterTypes, DetrendOperations, WindowOperations
+from brainflow.data_filter import DataFilter
+
+from scipy.fft import rfft, rfftfreq, next_fast_len
+from scipy.signal import butter, sosfiltfilt
 
 import numpy as np
 import utils
 
 class HeartRate(Base_Logic):
-    def __init__(self, board, fft_size=1024, ema_decay=0.025):
-        super().__init__(board)
+    def __init__(self, board, fft_size=1024, ema_decay=0.025, min_period_s=0.5):
+        super().__init__(board, min_period_s=min_period_s)
 
         board_id = board.get_board_id()
         
@@ -21,90 +24,148 @@ class HeartRate(Base_Logic):
         self.max_sample_size = self.ppg_sampling_rate * self.window_seconds
         self.fft_size = fft_size
 
+        # possible min and max heart rate and respiration in hz
+        self.hr_lowcut = 0.1
+        self.hr_highcut = 4.25
+        self.resp_lowcut = 0.1
+        self.resp_highcut = 0.5
+
+        # range the heart rate peak is searched in, 48 to 180 bpm
+        self.hr_peak_lowcut = 0.8
+        self.hr_peak_highcut = 3.0
+
+        # zero phase butterworth bandpass filters, designed once in single precision
+        self._sos_hr = butter(2, [self.hr_lowcut, self.hr_highcut], btype='band',
+                              fs=self.ppg_sampling_rate, output='sos').astype(np.float32)
+        self._sos_resp = butter(3, [self.resp_lowcut, self.resp_highcut], btype='band',
+                                fs=self.ppg_sampling_rate, output='sos').astype(np.float32)
+
+        # fft size and frequency bins, zero padded to a 2, 3, 5 smooth length so any window size stays fast
+        self._nfft = next_fast_len(self.max_sample_size, real=True)
+        self._freqs = rfftfreq(self._nfft, 1 / self.ppg_sampling_rate)
+
+        # frequency bins searched for the heart rate and respiration peaks
+        self._hr_band_idx = np.flatnonzero(
+            (self._freqs >= self.hr_peak_lowcut) & (self._freqs <= self.hr_peak_highcut))
+        self._hr_band_freqs = self._freqs[self._hr_band_idx]
+        self._resp_band_idx = np.flatnonzero(
+            (self._freqs >= self.resp_lowcut) & (self._freqs <= self.resp_highcut))
+        self._resp_band_freqs = self._freqs[self._resp_band_idx]
+
+        # centered sample index basis for linear detrending, fixed by the window size
+        self._detrend_basis = self.make_detrend_basis(self.max_sample_size)
+        self._detrend_denom = float(self._detrend_basis @ self._detrend_basis)
+
+        # reused ir and red buffers, double precision for brainflow and single precision for the fft path
+        self._ppg_buf = np.empty((2, self.max_sample_size), dtype=np.float64)
+        self._sig_buf = np.empty((2, self.max_sample_size), dtype=np.float32)
+
+        # signature of the last estimated window, skips estimates when no new samples arrived
+        self.signature_size = 64
+        self._last_signature = None
+
         # ema smoothing variables
         self.current_values = None
         self.ema_decay = ema_decay
 
-    def estimate_respiration(self, resp_signal):
-        # do not modify data
-        resp_signal = np.copy(resp_signal)
-
-        # Possible min and max respiration in hz
-        lowcut = 0.1
-        highcut = 0.5
-
-        # Detrend the signal to remove linear trends
-        DataFilter.detrend(resp_signal, DetrendOperations.LINEAR.value)
-
-        # filter down to possible respiration rates
-        DataFilter.perform_bandpass(resp_signal, self.ppg_sampling_rate, lowcut, highcut, 3, FilterTypes.BUTTERWORTH_ZERO_PHASE, 0)
-
-        # Perform FFT
-        fft_data = DataFilter.perform_fft(resp_signal, WindowOperations.NO_WINDOW.value)
-        fft_freq = np.linspace(0, self.ppg_sampling_rate / 2, len(fft_data) // 2)
-
-        # Find the peak frequency in the respiratory range
-        idx = np.where((fft_freq >= lowcut) & (fft_freq <= highcut))
-        peak_freq = fft_freq[idx][np.argmax(np.abs(fft_data[idx]))]
-
-        # Return breathing rate in BPM
-        return peak_freq * 60
-
-    def estimate_heart_rate(self, hr_ir, hr_red):
-        # do not modify data
-        hr_ir, hr_red = np.copy(hr_ir), np.copy(hr_red)
-
-        # Possible min and max heart rate in hz
-        lowcut = 0.1
-        highcut = 4.25
-
-        # Detrend the signal to remove linear trends
-        DataFilter.detrend(hr_ir, DetrendOperations.LINEAR.value)
-        DataFilter.detrend(hr_red, DetrendOperations.LINEAR.value)
-
-        # filter down to possible heart rates
-        DataFilter.perform_bandpass(hr_ir, self.ppg_sampling_rate, lowcut, highcut, 2, FilterTypes.BUTTERWORTH_ZERO_PHASE, 0)
-        DataFilter.perform_bandpass(hr_red, self.ppg_sampling_rate, lowcut, highcut, 2, FilterTypes.BUTTERWORTH_ZERO_PHASE, 0)
-
-        ### Brainflow Heart Example ###
-        ### https://github.com/brainflow-dev/brainflow/blob/master/python_package/examples/tests/muse_ppg.py ###
-        heart_bpm = DataFilter.get_heart_rate(hr_ir, hr_red, self.ppg_sampling_rate, self.fft_size)
-        heart_bps = heart_bpm / 60
+    @staticmethod
+    def make_detrend_basis(sample_size):
+        return (np.arange(sample_size) - (sample_size - 1) / 2).astype(np.float32)
+
+    def detrend_signals(self, sigs):
+        # window is shorter than expected right after startup, build a matching basis
+        basis, denom = self._detrend_basis, self._detrend_denom
+        if sigs.shape[-1] != basis.shape[0]:
+            basis = self.make_detrend_basis(sigs.shape[-1])
+            denom = float(basis @ basis)
+
+        # least squares line per row in place, the centered basis makes the intercept the row mean
+        slopes = (sigs @ basis) / denom
+        sigs -= sigs.mean(axis=-1, keepdims=True)
+        sigs -= slopes[:, np.newaxis] * basis
+        return sigs
+
+    def estimate_respiration(self, resp_fft):
+        # Find the peak frequency in the respiratory range per channel
+        band_fft = resp_fft[:, self._resp_band_idx]
+        peak_freqs = self._resp_band_freqs[np.argmax(np.abs(band_fft), axis=-1)]
+
+        # Return breathing rates in BPM
+        return peak_freqs * 60
+
+    def estimate_heart_rate(self, hr_fft):
+        # Find the peak of the combined ir and red power in the heart rate range
+        band_fft = hr_fft[:, self._hr_band_idx]
+        band_power = np.sum(band_fft.real ** 2 + band_fft.imag ** 2, axis=0)
+        heart_bps = self._hr_band_freqs[np.argmax(band_power)]
+        heart_bpm = heart_bps * 60
 
         return heart_bps, heart_bpm
 
-    def get_data_dict(self):
+    def estimate_targets(self):
         # get current data from board
         ppg_data = self.board.get_current_board_data(
             self.max_sample_size, BrainFlowPresets.ANCILLARY_PRESET)
-        
-        # get ambient, ir, red channels, and clean the channels with ambient
+
+        # reuse the last estimate if the newest samples are unchanged
+        signature = hash(ppg_data[self.ppg_channels, -self.signature_size:].tobytes())
+        if signature == self._last_signature:
+            return self._cached
+        self._last_signature = signature
+
+        # get ambient, ir, red channels, and clean the channels with ambient into the reused buffer
+        sample_size = ppg_data.shape[1]
         ppg_ambient = ppg_data[self.ppg_channels[2]]
-        ppg_ir = ppg_data[self.ppg_channels[1]] - ppg_ambient
-        ppg_red = ppg_data[self.ppg_channels[0]] - ppg_ambient
+        ppg_ir = self._ppg_buf[0, :sample_size]
+        ppg_red = self._ppg_buf[1, :sample_size]
+        np.subtract(ppg_data[self.ppg_channels[1]], ppg_ambient, out=ppg_ir)
+        np.subtract(ppg_data[self.ppg_channels[0]], ppg_ambient, out=ppg_red)
 
         # calculate oxygen level
         oxygen_level = DataFilter.get_oxygen_level(ppg_ir, ppg_red, self.ppg_sampling_rate) * 0.01
 
+        # ir and red as single precision, which is enough for the filter and fft path
+        ppg_sigs = self._sig_buf[:, :sample_size]
+        np.copyto(ppg_sigs, self._ppg_buf[:, :sample_size], casting='same_kind')
+
+        # detrend once in place to remove linear trends, shared by heartrate and respiration
+        self.detrend_signals(ppg_sigs)
+
+        # filter down to possible heart and respiration rates
+        hr_sigs = sosfiltfilt(self._sos_hr, ppg_sigs, axis=-1)
+        resp_sigs = sosfiltfilt(self._sos_resp, ppg_sigs, axis=-1)
+
+        # Perform FFT on all filtered channels in one batched call
+        fft_data = rfft(np.concatenate((hr_sigs, resp_sigs)), n=self._nfft, axis=-1, workers=-1)
+
         # calculate heartrate
-        heart_bps, heart_bpm = self.estimate_heart_rate(ppg_ir, ppg_red)
+        heart_bps, heart_bpm = self.estimate_heart_rate(fft_data[:2])
 
         # calculate respiration
-        resp_ir = self.estimate_respiration(ppg_ir)
-        resp_red = self.estimate_respiration(ppg_red)
+        resp_ir, resp_red = self.estimate_respiration(fft_data[2:])
         resp_avg = np.mean((resp_ir, resp_red))
 
-        osc_param_names = ["osc_oxygen_percent", "osc_heart_bps", "osc_heart_bpm", "osc_respiration_bpm"]
-        target_values = np.array([oxygen_level, heart_bps, heart_bpm, resp_avg])
+        return {
+            "osc_oxygen_percent": float(oxygen_level),
+            "osc_heart_bps": float(heart_bps),
+            "osc_heart_bpm": float(heart_bpm),
+            "osc_respiration_bpm": float(resp_avg)
+        }
+
+    def get_data_dict(self):
+        # heart rate changes over seconds, only re-estimate every min_period_s
+        if self.should_update():
+            self._cached = self.estimate_targets()
 
-        # smooth using exponential moving average
-        if not isinstance(self.current_values, np.ndarray):
-            self.current_values = target_values
+        # smooth in place using exponential moving average, plain floats are cheaper than numpy for 4 values
+        if self.current_values is None:
+            self.current_values = list(self._cached.values())
         else:
-            self.current_values = utils.smooth(self.current_values, target_values, self.ema_decay)
-        
+            for i, target_value in enumerate(self._cached.values()):
+                self.current_values[i] = utils.smooth(self.current_values[i], target_value, self.ema_decay)
+
         # format as dict and round bpm values
-        ret_dict = {k:v for k,v in zip(osc_param_names, self.current_values.tolist())}
+        ret_dict = dict(zip(self._cached.keys(), self.current_values))
         ret_dict["osc_heart_bpm"] = int(ret_dict["osc_heart_bpm"] + 0.5)
         ret_dict["osc_respiration_bpm"] = int(ret_dict["osc_respiration_bpm"] + 0.5)
 
@@ -1,12 +1,13 @@
 import argparse
 import time
-from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds
 from brainflow.data_filter import DataFilter
 from brainflow.exit_codes import BrainFlowError
 
 from pythonosc.udp_client import SimpleUDPClient
+from pythonosc import osc_bundle_builder, osc_message_builder
 
 from constants import OSC_Path, OSC_BASE_PATH
 
@@ -23,12 +24,24 @@ def tryFunc(func, val):
         return None
 
 
+def send_osc_bundle(osc_client, osc_dict):
+    # pack every parameter into one bundle so a frame is a single udp packet
+    bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+    for osc_name, osc_value in osc_dict.items():
+        msg = osc_message_builder.OscMessageBuilder(address=OSC_BASE_PATH + osc_name)
+        msg.add_arg(osc_value)
+        bundle.add_content(msg.build())
+    osc_client.send(bundle.build())
+
+
 def main():
     BoardShim.enable_board_logger()
     DataFilter.enable_data_logger()
 
-    ### Uncomment this to see debug messages ###
-    # BoardShim.set_log_level(LogLevels.LEVEL_DEBUG.value)
+    ### Set this to True to see debug messages ###
+    debug_logging = False
+    if debug_logging:
+        BoardShim.set_log_level(LogLevels.LEVEL_DEBUG.value)
 
     ### Paramater Setting ###
     parser = argparse.ArgumentParser()
@@ -69,6 +82,8 @@ def main():
                         help='ip address of the osc listener', required=False, default="127.0.0.1")
     parser.add_argument('--osc-port', type=int,
                         help='port the osc listener', required=False, default=9000)
+    parser.add_argument('--osc-send', action='store_true',
+                        help='send the calculated parameters to the osc listener every frame', required=False)
     
     args = parser.parse_args()
 
@@ -125,27 +140,37 @@ def main():
         # Initialize board and logics
         board, logics, refresh_rate_hz = BoardInit(args)
 
+        # logics spend most of their time in brainflow and scipy calls that release the gil
+        logic_pool = ThreadPoolExecutor(max_workers=len(logics))
+
+        # reused every frame, each logic updates its own keys in place
+        frame_dict = {}
+
+        # deadline of the next frame on the monotonic clock
+        next_deadline = time.monotonic()
+
         def board_update(board, logics, refresh_rate_hz):
+            nonlocal next_deadline
             try:
-                # get execution start time for time delay
-                start_time = time.time()
-                
                 # Execute all logic
                 BoardShim.log_message(LogLevels.LEVEL_DEBUG.value, "Execute all Logic")
-                data_dicts = list(map(lambda logic: logic.get_data_dict(), logics))
-                full_dict = dict(ChainMap(*data_dicts))
-
-                # Send messages from executed logic
-                BoardShim.log_message(LogLevels.LEVEL_DEBUG.value, "Sending")
-                for osc_name in full_dict:
-                    BoardShim.log_message(LogLevels.LEVEL_DEBUG.value, "{}:\t{:.3f}".format(osc_name, full_dict[osc_name]))
+                list(logic_pool.map(lambda logic: logic.update_into(frame_dict), logics))
+
+                # Log messages from executed logic
+                BoardShim.log_message(LogLevels.LEVEL_DEBUG.value, "Logging")
+                if debug_logging:
+                    debug_level = LogLevels.LEVEL_DEBUG.value
+                    for osc_name, osc_value in frame_dict.items():
+                        BoardShim.log_message(debug_level, "%s:\t%.3f" % (osc_name, osc_value))
                 
-                # sleep based on refresh_rate
+                # sleep until the next frame deadline, resync if we fell behind
                 BoardShim.log_message(LogLevels.LEVEL_DEBUG.value, "Sleeping")
-                execution_time = time.time() - start_time
-                sleep_time = 1.0 / refresh_rate_hz - execution_time
-                sleep_time = sleep_time if sleep_time > 0 else 0
-                time.sleep(sleep_time)
+                next_deadline += 1.0 / refresh_rate_hz
+                slack = next_deadline - time.monotonic()
+                if slack > 0:
+                    time.sleep(slack)
+                else:
+                    next_deadline = time.monotonic()
 
             except TimeoutError as e:
                 # display disconnect and release old session
@@ -161,10 +186,11 @@ def main():
                         break
                     except BrainFlowError as e:
                         BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'Retry {} Biosensor board error: {}'.format(i, str(e)))
-                
+
+                next_deadline = time.monotonic()
                 return None
             
-            return full_dict
+            return frame_dict
             
         # ウィンドウのサイズとグラフの範囲
         window_size = (400, 300)
@@ -183,14 +209,23 @@ def main():
         # 各値のラベル
         bar_labels = ["Alpha", "Beta", "Theta", "Delta", "Gamma"]
 
-        def draw_bar_graph(graph, values):
-            graph.erase()
-            for i, value in enumerate(values):
-                # グラフの描画
-                graph.draw_rectangle(top_left=(i * 60 + 10, value), bottom_right=(i * 60 + 50, 0), fill_color='blue')
+        def create_bar_graph(graph):
+            bar_ids = []
+            for i, bar_label in enumerate(bar_labels):
+                # グラフの描画 (高さ0で作成し、以降は座標のみ更新する)
+                bar_ids.append(graph.draw_rectangle(top_left=(i * 60 + 10, 0), bottom_right=(i * 60 + 50, 0), fill_color='blue'))
                 # ラベルの描画
-                graph.draw_text(text=bar_labels[i], location=(i * 60 + 30, 0.9), color='black', font=('Helvetica', 10))
+                graph.draw_text(text=bar_label, location=(i * 60 + 30, 0.9), color='black', font=('Helvetica', 10))
+            return bar_ids
 
+        def draw_bar_graph(graph, bar_ids, values):
+            # キャンバス全体を再描画せず、各矩形の座標だけを更新する
+            for i, (bar_id, value) in enumerate(zip(bar_ids, values)):
+                x0, y0 = graph._convert_xy_to_canvas_xy(i * 60 + 10, value)
+                x1, y1 = graph._convert_xy_to_canvas_xy(i * 60 + 50, 0)
+                graph.TKCanvas.coords(bar_id, x0, y0, x1, y1)
+
+        bar_ids = create_bar_graph(graph)
 
         while True:  # イベントループ
             event, values = window.read(timeout=10)  # 10[ms]ごとにウィンドウを更新
@@ -199,6 +234,11 @@ def main():
 
             # ランダムな値でグラフを更新
             full_dict = board_update(board, logics, refresh_rate_hz)
+
+            # OSCで計算結果を1つのバンドルとして送信
+            if args.osc_send and full_dict:
+                send_osc_bundle(osc_client, full_dict)
+
             #各脳波の左右平均の値をfull_dictから抜き出す
             # new_values = [tryFunc(lambda x: x, full_dict["osc_band_power_avg_alpha"]), 
             #               tryFunc(lambda x: x, full_dict["osc_band_power_avg_beta"]), 
@@ -206,7 +246,7 @@ def main():
             #               tryFunc(lambda x: x, full_dict["osc_band_power_avg_delta"]), 
             #               tryFunc(lambda x: x, full_dict["osc_band_power_avg_gamma"])]
             new_values = [full_dict["osc_band_power_avg_alpha"], full_dict["osc_band_power_avg_beta"], full_dict["osc_band_power_avg_theta"], full_dict["osc_band_power_avg_delta"], full_dict["osc_band_power_avg_gamma"]]
-            draw_bar_graph(graph, new_values)
+            draw_bar_graph(graph, bar_ids, new_values)
 
         window.close()
 
@@ -218,6 +258,7 @@ def main():
     finally:
         osc_client.send_message(OSC_Path.ConnectionStatus, False)
         board.release_session()
+        logic_pool.shutdown()
 
 
 if __name__ == "__main__":